@@ -1,13 +1,18 @@
 import streamlit as st
-from PyPDF2 import PdfReader
-import docx
-from pdf2image import convert_from_path
-import pytesseract
-from PIL import Image
-import json
+import io
+import hashlib
 import os
 import random
-import requests
+import re
+import time
+from email.utils import parsedate_to_datetime
+import asyncio
+import multiprocessing
+import httpx
+import orjson
+import diskcache
+from concurrent.futures import ProcessPoolExecutor
+import ocr_worker
 
 # ----------------- AI Mode Selection -----------------
 USE_REAL_AI = st.sidebar.checkbox("Use Real AI (Deepseek R1)", value=False)
@@ -17,61 +22,183 @@ DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
 st.write("DEBUG: DEEPSEEK_API_KEY =", "SET" if DEEPSEEK_API_KEY else "None")
 
 # ----------------- Guideline Handling -----------------
-def extract_text_from_pdf(file):
+# Extractors take the raw upload bytes so st.cache_data can key on them;
+# reruns with the same upload skip parsing/OCR entirely. The PDF/OCR/DOCX
+# libraries are imported on first use to keep them off the cold-start path.
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_pdf(data):
+    from pypdf import PdfReader
     try:
-        reader = PdfReader(file)
-        text = ""
+        reader = PdfReader(io.BytesIO(data))
+        parts = []
         for page in reader.pages:
-            text += page.extract_text() or ""
-        return text.strip()
+            parts.append(page.extract_text() or "")
+        return "".join(parts).strip()
     except:
         return None
 
-def ocr_pdf(file_path):
-    images = convert_from_path(file_path)
-    text = ""
-    for img in images:
-        text += pytesseract.image_to_string(img)
-    return text.strip()
+# Born-digital PDFs with at least this much extracted text skip the OCR fallback
+OCR_MIN_TEXT_CHARS = 1000
 
-def extract_text_from_docx(file):
-    doc = docx.Document(file)
-    return "\n".join([p.text for p in doc.paragraphs])
+def _ocr_concurrency():
+    """OCR_CONCURRENCY from the environment; falls back to the CPU count if unset or invalid"""
+    default = os.cpu_count() or 1
+    try:
+        value = int(os.environ.get("OCR_CONCURRENCY", default))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+# Maximum pages OCR'd in parallel; defaults to one worker process per core
+OCR_CONCURRENCY = _ocr_concurrency()
+# Forking the multi-threaded Streamlit server can deadlock the child, so workers are
+# started from a clean forkserver (spawn where that isn't available)
+_OCR_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# Pages are rasterized in grayscale at this DPI; Tesseract time scales with pixel count
+OCR_DPI = 150
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def ocr_pdf(data):
+    from pdf2image import convert_from_bytes
+    images = convert_from_bytes(data, dpi=OCR_DPI, grayscale=True, thread_count=OCR_CONCURRENCY)
+    if not images:
+        return ""
+    # Never start more workers than there are pages; each one is a new process that loads the model
+    workers = min(OCR_CONCURRENCY, len(images))
+    if workers == 1:
+        with ocr_worker.new_api() as api:
+            texts = [ocr_worker.read_page(api, img) for img in images]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_OCR_MP_CONTEXT, initializer=ocr_worker.init_worker) as ex:
+            texts = list(ex.map(ocr_worker.ocr_page, images))
+    return "".join(texts).strip()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_docx(data):
+    import docx
+    doc = docx.Document(io.BytesIO(data))
+    return "\n".join(p.text for p in doc.paragraphs if p.text)
+
+def guideline_fingerprint(data):
+    """Stable identity for a guideline, shared by every downstream cache key"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 # ----------------- Template Management -----------------
 TEMPLATE_DIR = "templates"
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
-def list_templates():
+# Listing and loading are cached on the directory/file mtime: saving or
+# deleting a template bumps the mtime, which invalidates the cached entry.
+# Only the latest listing is kept; loads keep one entry per recently used template.
+@st.cache_data(show_spinner=False, max_entries=1)
+def _list_templates(dir_mtime):
     return [f.replace(".json", "") for f in os.listdir(TEMPLATE_DIR) if f.endswith(".json")]
 
+def list_templates():
+    return _list_templates(os.path.getmtime(TEMPLATE_DIR))
+
 def save_template(name, data):
-    with open(os.path.join(TEMPLATE_DIR, f"{name}.json"), "w") as f:
-        json.dump(data, f, indent=2)
+    with open(os.path.join(TEMPLATE_DIR, f"{name}.json"), "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_template(name, mtime):
+    with open(os.path.join(TEMPLATE_DIR, f"{name}.json"), "rb") as f:
+        return orjson.loads(f.read())
 
 def load_template(name):
-    with open(os.path.join(TEMPLATE_DIR, f"{name}.json"), "r") as f:
-        return json.load(f)
+    return _load_template(name, os.path.getmtime(os.path.join(TEMPLATE_DIR, f"{name}.json")))
 
 def delete_template(name):
     os.remove(os.path.join(TEMPLATE_DIR, f"{name}.json"))
 
 # ----------------- AI Inference -----------------
-def get_ai_suggestions_openrouter(task_template, guideline_text, user_text, image_descriptions=None):
-    """Call OpenRouter Deepseek R1 API and return option + reasoning"""
-    suggestions = {}
-    if not DEEPSEEK_API_KEY:
-        st.error("Please set DEEPSEEK_API_KEY in Replit Secrets!")
-        return {}
-
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_MODEL = "deepseek/deepseek-chat-v3.1:free"
+MAX_CONCURRENT_REQUESTS = 8
+# Connection pool and retry policy for OpenRouter calls. Connect errors are
+# retried by the transport; rate limits and 5xx responses back off in _post_chat.
+HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+HTTP_CONNECT_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+# Longest Retry-After we'll honour; OpenRouter's free-tier limits are per minute
+RETRY_AFTER_MAX = 60
+# Seconds to wait for a single answer; batched requests get extra time per question
+REQUEST_TIMEOUT = 30
+BATCH_TIMEOUT_PER_QUESTION = 10
+
+# Splits an "Option: ... / Reason: ..." answer in one pass when rendering suggestions
+_ANS_RE = re.compile(r"Option:\s*(.*?)\s*\nReason:\s*(.*)", re.DOTALL)
+
+# Templates longer than this are split into several batched requests
+MAX_QUESTIONS_PER_BATCH = 15
+
+# Answers are cached on disk so unchanged (guideline, task, question) inputs skip the API
+AI_CACHE_DIR = ".aicache"
+AI_CACHE_EXPIRE = 7 * 86400
+
+@st.cache_resource
+def _answer_cache():
+    return diskcache.Cache(AI_CACHE_DIR)
+
+def _answer_cache_key(guideline_hash, user_text, images_joined, q):
+    # Hash a structured encoding so free-form fields containing separators can't collide
+    raw = orjson.dumps([OPENROUTER_MODEL, guideline_hash, user_text, images_joined, q['question'], q['options']])
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _retry_delay(resp, attempt):
+    """Seconds to wait before retrying: the server's Retry-After if given, else exponential backoff"""
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), RETRY_AFTER_MAX)
+    return RETRY_BACKOFF_FACTOR * 2 ** attempt
+
+async def _post_chat(client, sem, headers, prompt, json_mode=False, timeout=REQUEST_TIMEOUT):
+    """POST a single-message chat completion; returns (content, None, False) or (None, error, retries_exhausted)
+
+    retries_exhausted is True when a rate limit / server error status persisted through
+    all the retries, i.e. sending more requests right away won't help.
+    """
+    payload = {
+        "model": OPENROUTER_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0
     }
+    if json_mode:
+        payload["response_format"] = {"type": "json_object"}
 
-    for q in task_template:
-        prompt = f"""
+    async with sem:
+        try:
+            for attempt in range(RETRY_TOTAL + 1):
+                resp = await client.post(OPENROUTER_URL, headers=headers, json=payload, timeout=timeout)
+                if resp.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                    break
+                await asyncio.sleep(_retry_delay(resp, attempt))
+        except httpx.HTTPError as e:
+            return None, f"Request Exception: {e!r}", False
+
+    if resp.status_code != 200:
+        return None, f"Error {resp.status_code}: {resp.text}", resp.status_code in RETRY_STATUSES
+    try:
+        return resp.json()["choices"][0]["message"]["content"].strip(), None, False
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        return None, f"Invalid response: {e!r}: {resp.text[:500]}", False
+
+def _prompt_header(guideline_text, user_text, images_joined):
+    """Shared prompt prefix; built once per generation and reused by every request"""
+    return f"""
 You are a grading assistant.
 Guideline:
 {guideline_text}
@@ -80,9 +207,13 @@ User task description:
 {user_text}
 
 Image descriptions:
-{', '.join(image_descriptions) if image_descriptions else 'No images'}
+{images_joined}
 
-Please select the most appropriate answer for the following question based on the guideline and task, and briefly explain your reasoning:
+"""
+
+async def _ask(client, sem, headers, header, q):
+    """Ask the model a single template question; returns (answer or error text, failed)"""
+    prompt = header + f"""Please select the most appropriate answer for the following question based on the guideline and task, and briefly explain your reasoning:
 Question: {q['question']}
 Options: {', '.join(q['options'])}
 
@@ -90,37 +221,158 @@ Please return in the following format:
 Option: <your chosen option>
 Reason: <brief explanation>
 """
-        payload = {
-            "model": "deepseek/deepseek-chat-v3.1:free",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0
-        }
-
-        try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=30)
-            if resp.status_code == 200:
-                answer = resp.json()["choices"][0]["message"]["content"].strip()
-            else:
-                answer = f"Error {resp.status_code}: {resp.text}"
-        except requests.exceptions.RequestException as e:
-            answer = f"Request Exception: {e}"
+    answer, error, _ = await _post_chat(client, sem, headers, prompt)
+    return (answer, False) if error is None else (error, True)
+
+def _normalize(text):
+    return " ".join(text.split()).casefold()
+
+def _parse_batch_answers(content, shard):
+    """Map a batched JSON reply onto the shard's questions; None where an answer is unusable
+
+    Answers are matched on the echoed 1-based index, then the echoed question text, then
+    list position when the reply has exactly one entry per question. Either way the
+    chosen option must be one of the question's options.
+    """
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.strip("`").removeprefix("json").strip()
+    try:
+        items = orjson.loads(content)["answers"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return [None] * len(shard)
+    if not isinstance(items, list):
+        return [None] * len(shard)
+
+    by_index = {}
+    by_question = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        if isinstance(index, str) and index.strip().isdigit():
+            index = int(index)
+        if isinstance(index, int) and not isinstance(index, bool):
+            by_index.setdefault(index, item)
+        if isinstance(item.get("question"), str):
+            by_question.setdefault(_normalize(item["question"]), item)
+    positional = len(items) == len(shard)
+
+    answers = []
+    for i, q in enumerate(shard, 1):
+        item = by_index.get(i) or by_question.get(_normalize(q['question']))
+        if item is None and positional and isinstance(items[i - 1], dict):
+            item = items[i - 1]
+        options = {_normalize(opt): opt for opt in q['options']}
+        # Only a string can name an option; e.g. a JSON null must not match an option "None"
+        chosen = item.get("option") if item else None
+        option = options.get(_normalize(chosen)) if isinstance(chosen, str) else None
+        if option is None:
+            answers.append(None)
+        else:
+            answers.append(f"Option: {option}\nReason: {item.get('reason') or ''}")
+    return answers
+
+async def _ask_batch(client, sem, headers, header, shard):
+    """Ask a shard of questions in one request, falling back per question where that request fails
+
+    Returns one (answer or error text, failed) pair per question.
+    """
+    question_block = "\n".join(
+        f"Question {i}: {q['question']}\nOptions {i}: {', '.join(q['options'])}"
+        for i, q in enumerate(shard, 1)
+    )
+    prompt = header + f"""For each of the following questions, select the most appropriate option based on the guideline and task, and briefly explain your reasoning:
+{question_block}
+
+Return only a JSON object in the following format, with one entry per question in the same order:
+{{"answers": [{{"index": <question number>, "question": "<question text>", "option": "<your chosen option>", "reason": "<brief explanation>"}}]}}
+"""
+    timeout = REQUEST_TIMEOUT + BATCH_TIMEOUT_PER_QUESTION * len(shard)
+    content, error, retries_exhausted = await _post_chat(client, sem, headers, prompt, json_mode=True, timeout=timeout)
+    if error is not None and retries_exhausted:
+        # Still rate limited / failing after retries; one request per question would only add load
+        return [(error, True)] * len(shard)
+
+    # Other failures (e.g. response_format rejected, timeout, malformed reply) retry question by question
+    answers = _parse_batch_answers(content, shard) if error is None else [None] * len(shard)
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    fallback = await asyncio.gather(*[
+        _ask(client, sem, headers, header, shard[i])
+        for i in missing
+    ])
+    results = [(answer, False) for answer in answers]
+    for i, result in zip(missing, fallback):
+        results[i] = result
+    return results
+
+async def get_ai_suggestions_openrouter_async(task_template, guideline_text, user_text, image_descriptions=None, guideline_fp=None):
+    """Ask the template questions in batched requests and return option + reasoning per question"""
+    headers = {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    cache = _answer_cache()
+    guideline_hash = guideline_fp or guideline_fingerprint(guideline_text.encode())
+    images_joined = ', '.join(image_descriptions) if image_descriptions else 'No images'
 
-        suggestions[q['question']] = answer
+    suggestions = {}
+    keys = {}
+    pending = []
+    for q in task_template:
+        key = _answer_cache_key(guideline_hash, user_text, images_joined, q)
+        answer = cache.get(key)
+        if answer is not None:
+            suggestions[q['question']] = answer
+        else:
+            keys[q['question']] = key
+            pending.append(q)
+
+    if pending:
+        header = _prompt_header(guideline_text, user_text, images_joined)
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        shards = [
+            pending[i:i + MAX_QUESTIONS_PER_BATCH]
+            for i in range(0, len(pending), MAX_QUESTIONS_PER_BATCH)
+        ]
+
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=HTTP_CONNECT_RETRIES)
+        async with httpx.AsyncClient(transport=transport) as client:
+            results = await asyncio.gather(*[
+                _ask_batch(client, sem, headers, header, shard)
+                for shard in shards
+            ])
+
+        for shard, answers in zip(shards, results):
+            for q, (answer, failed) in zip(shard, answers):
+                suggestions[q['question']] = answer
+                if not failed:
+                    cache.set(keys[q['question']], answer, expire=AI_CACHE_EXPIRE)
+
+    # Preserve template order regardless of which answers came from the cache
+    return {q['question']: suggestions[q['question']] for q in task_template}
+
+def get_ai_suggestions_openrouter(task_template, guideline_text, user_text, image_descriptions=None, guideline_fp=None):
+    """Call OpenRouter Deepseek R1 API and return option + reasoning"""
+    if not DEEPSEEK_API_KEY:
+        st.error("Please set DEEPSEEK_API_KEY in Replit Secrets!")
+        return {}
 
-    return suggestions
+    return asyncio.run(get_ai_suggestions_openrouter_async(task_template, guideline_text, user_text, image_descriptions, guideline_fp))
 
-def get_ai_suggestions_mock(task_template):
-    """Mock AI: randomly choose an option with a simple reasoning"""
+def get_ai_suggestions_mock(task_template, seed=None):
+    """Mock AI: randomly choose an option with a simple reasoning (deterministic when seeded)"""
+    rng = random.Random(seed)
     suggestions = {}
     for q in task_template:
-        choice = random.choice(q['options'])
+        choice = rng.choice(q['options'])
         reason = "This is a mock reason explaining why this option could be chosen."
         suggestions[q['question']] = f"Option: {choice}\nReason: {reason}"
     return suggestions
 
-def get_ai_suggestions(guideline_text, user_text, task_template, image_descriptions=None):
+def get_ai_suggestions(guideline_text, user_text, task_template, image_descriptions=None, guideline_fp=None):
     if USE_REAL_AI:
-        return get_ai_suggestions_openrouter(task_template, guideline_text, user_text, image_descriptions)
+        return get_ai_suggestions_openrouter(task_template, guideline_text, user_text, image_descriptions, guideline_fp)
     else:
         return get_ai_suggestions_mock(task_template)
 
@@ -131,16 +383,35 @@ st.title("📘 ProGrader App - AI Grading")
 st.header("Step 1: Upload Guideline")
 uploaded_file = st.file_uploader("Upload a guideline (PDF or DOCX)", type=["pdf", "docx"])
 guideline_text = ""
+guideline_fp = None
 if uploaded_file is not None:
-    if uploaded_file.name.endswith(".pdf"):
-        guideline_text = extract_text_from_pdf(uploaded_file)
-        if not guideline_text:
-            st.warning("No text found, trying OCR...")
-            with open("temp.pdf", "wb") as f:
-                f.write(uploaded_file.read())
-            guideline_text = ocr_pdf("temp.pdf")
+    # Reruns for the same upload reuse the text and fingerprint without re-reading or
+    # hashing the file; both are stored together so they always describe the same upload
+    file_id = getattr(uploaded_file, "file_id", None)
+    guideline_cache = st.session_state.setdefault("_guideline_cache", {})
+    if file_id is not None and file_id in guideline_cache:
+        guideline_text, guideline_fp = guideline_cache[file_id]
     else:
-        guideline_text = extract_text_from_docx(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        guideline_fp = guideline_fingerprint(file_bytes)
+        if uploaded_file.name.endswith(".pdf"):
+            guideline_text = extract_text_from_pdf(file_bytes) or ""
+            if len(guideline_text) < OCR_MIN_TEXT_CHARS:
+                st.warning("Little or no text found, trying OCR...")
+                try:
+                    ocr_text = ocr_pdf(file_bytes)
+                except Exception as e:
+                    # e.g. poppler or tessdata missing, or a broken worker pool
+                    st.warning(f"OCR failed ({e!r}); using the extracted text only.")
+                    ocr_text = ""
+                if len(ocr_text) > len(guideline_text):
+                    guideline_text = ocr_text
+        else:
+            guideline_text = extract_text_from_docx(file_bytes)
+        # Only the current upload is kept
+        guideline_cache.clear()
+        if file_id is not None:
+            guideline_cache[file_id] = (guideline_text, guideline_fp)
     st.subheader("📄 Extracted Guideline Text")
     st.text_area("Content", guideline_text, height=300)
 
@@ -198,6 +469,7 @@ selected_template_for_task = st.selectbox("Select Template for this task", templ
 
 image_descriptions = []
 if task_images:
+    from PIL import Image
     st.subheader("🖼️ Uploaded Task Images")
     for img in task_images:
         st.image(Image.open(img), caption=img.name, use_container_width=True)
@@ -209,7 +481,7 @@ if selected_template_for_task and guideline_text and user_text:
     task_template = load_template(selected_template_for_task)
     if st.button("🤖 Generate AI Suggestions"):
         with st.spinner("Generating AI suggestions..."):
-            suggestions = get_ai_suggestions(guideline_text, user_text, task_template, image_descriptions)
+            suggestions = get_ai_suggestions(guideline_text, user_text, task_template, image_descriptions, guideline_fp)
         st.session_state["ai_suggestions"] = suggestions
 
     if "ai_suggestions" in st.session_state:
@@ -217,10 +489,10 @@ if selected_template_for_task and guideline_text and user_text:
         for q_text, answer in st.session_state["ai_suggestions"].items():
             st.write(f"**Q:** {q_text}")
             # Separate option and reasoning
-            if "\n" in answer:
-                option, reason = answer.split("\n", 1)
-                st.write(f"**AI Suggestion:** {option.replace('Option:','').strip()}")
-                st.write(f"**Reason:** {reason.replace('Reason:','').strip()}")
+            m = _ANS_RE.search(answer)
+            if m:
+                st.write(f"**AI Suggestion:** {m.group(1)}")
+                st.write(f"**Reason:** {m.group(2).strip()}")
             else:
                 st.write(f"**AI Suggestion:** {answer}")
 else:
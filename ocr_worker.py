@@ -0,0 +1,28 @@
+"""Tesseract OCR helpers for the ProcessPoolExecutor used by main.ocr_pdf.
+
+These live in a regular importable module rather than the Streamlit script:
+Streamlit re-creates the script's __main__ module on every rerun, so a worker
+function and its per-process API handle defined there can resolve to
+different module objects in the pool's workers.
+"""
+
+# Each worker process loads the Tesseract model once and reuses it for every page
+_api = None
+
+def new_api():
+    from tesserocr import PyTessBaseAPI, OEM, PSM
+    # LSTM engine, single uniform block of text
+    return PyTessBaseAPI(oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_BLOCK)
+
+def read_page(api, img):
+    api.SetImage(img)
+    return api.GetUTF8Text()
+
+def init_worker():
+    """ProcessPoolExecutor initializer: create this worker's Tesseract handle"""
+    global _api
+    _api = new_api()
+
+def ocr_page(img):
+    """OCR a single page image with this worker's Tesseract handle"""
+    return read_page(_api, img)
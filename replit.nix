@@ -1,5 +1,7 @@
 { pkgs }: {
   deps = [
     pkgs.poppler_utils
+    # tessdata for tesserocr at runtime
+    pkgs.tesseract
   ];
 }
\ No newline at end of file